@@ -170,6 +170,225 @@ class TestNeuropythy(unittest.TestCase):
         fmp = mpj(ctx)
         pth = trc.to_path(fmp)
         self.assertTrue(np.isclose(1600, pth.surface_area))
-        
+
+    def test_pseudo_dir_parallel(self):
+        '''
+        test_pseudo_dir_parallel ensures that the members of a tarball that are fetched in parallel
+          by pseudo_dir(...).prefetch_parallel() are extracted intact.
+        '''
+        import tarfile, tempfile, shutil
+        logging.info('neuropythy: Testing parallel extraction from tarballs')
+        tmp = tempfile.mkdtemp(prefix='npythy_test_')
+        try:
+            src = os.path.join(tmp, 'src')
+            data = {}
+            for ii in range(200):
+                flnm = os.path.join('sub%d' % (ii % 10), 'file%03d.dat' % ii)
+                dnm = os.path.join(src, os.path.dirname(flnm))
+                if not os.path.isdir(dnm): os.makedirs(dnm)
+                data[flnm] = os.urandom(1024 * (1 + ii % 37))
+                with open(os.path.join(src, flnm), 'wb') as fl: fl.write(data[flnm])
+            # a few symlinks, which can't be copied directly out of the tarball
+            for ii in range(5):
+                flnm = os.path.join('sub%d' % ii, 'link%d.dat' % ii)
+                os.symlink('file%03d.dat' % ii, os.path.join(src, flnm))
+                data[flnm] = data[os.path.join('sub%d' % ii, 'file%03d.dat' % ii)]
+            tb = os.path.join(tmp, 'data.tar')
+            with tarfile.open(tb, 'w') as tfl:
+                for d in sorted(os.listdir(src)): tfl.add(os.path.join(src, d), arcname=d)
+            pd = ny.util.pseudo_dir(tb, cache_path=os.path.join(tmp, 'cache'))
+            pd.prefetch_parallel(list(data.keys()))
+            for (flnm, dat) in six.iteritems(data):
+                with open(pd.local_path(flnm), 'rb') as fl: self.assertEqual(fl.read(), dat)
+            # again, as if the cache were on another filesystem (copy_file_range fails with EXDEV)
+            if hasattr(os, 'copy_file_range'):
+                import errno
+                cfr = os.copy_file_range
+                def exdev(*args): raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+                os.copy_file_range = exdev
+                try:
+                    pd = ny.util.pseudo_dir(tb, cache_path=os.path.join(tmp, 'cache2'))
+                    pd.prefetch_parallel(list(data.keys()))
+                finally: os.copy_file_range = cfr
+                for (flnm, dat) in six.iteritems(data):
+                    with open(pd.local_path(flnm), 'rb') as fl: self.assertEqual(fl.read(), dat)
+        finally: shutil.rmtree(tmp, True)
+
+    def test_tarball_escape(self):
+        '''
+        test_tarball_escape ensures that members of a tarball can't be extracted outside of the
+          cache directory of its pseudo-dir.
+        '''
+        import tarfile, tempfile, shutil, io
+        logging.info('neuropythy: Testing extraction of unsafe tarball members')
+        tmp = tempfile.mkdtemp(prefix='npythy_test_')
+        try:
+            for (ext, mode) in [('.tar', 'w'), ('.tar.bz2', 'w:bz2')]:
+                tb = os.path.join(tmp, 'data' + ext)
+                with tarfile.open(tb, mode) as tfl:
+                    for flnm in ['ok.txt', '../../escaped.txt']:
+                        ti = tarfile.TarInfo(flnm)
+                        ti.size = 2
+                        tfl.addfile(ti, io.BytesIO(b'ok'))
+                cp = os.path.join(tmp, 'a', 'b', 'cache' + ext)
+                pd = ny.util.pseudo_dir(tb, cache_path=cp)
+                with self.assertRaises((ValueError, tarfile.TarError)):
+                    pd.local_path('../../escaped.txt')
+                # compressed tarballs are extracted in full, so the whole tarball is refused
+                if ext == '.tar':
+                    with open(pd.local_path('ok.txt'), 'r') as fl: self.assertEqual(fl.read(), 'ok')
+                else:
+                    with self.assertRaises((ValueError, tarfile.TarError)): pd.local_path('ok.txt')
+                self.assertFalse(any('escaped.txt' in fls for (_,_,fls) in os.walk(tmp)))
+        finally: shutil.rmtree(tmp, True)
+
+    def test_pseudo_dir_url(self):
+        '''
+        test_pseudo_dir_url tests pseudo-dirs of URLs and of URL-hosted tarballs using a local HTTP
+          server: downloads and extractions must be complete, unsafe tarball members must be
+          refused, and failed transfers must not leave files in the cache.
+        '''
+        import tarfile, tempfile, shutil, io, threading
+        from six.moves.BaseHTTPServer import (HTTPServer, BaseHTTPRequestHandler)
+        from neuropythy.util.filemap import PseudoDir
+        logging.info('neuropythy: Testing URL pseudo-dirs')
+        def make_tarball(files, mode='w:gz'):
+            bts = io.BytesIO()
+            with tarfile.open(fileobj=bts, mode=mode) as tfl:
+                for (flnm, dat) in six.iteritems(files):
+                    ti = tarfile.TarInfo(flnm)
+                    ti.size = len(dat)
+                    tfl.addfile(ti, io.BytesIO(dat))
+            return bts.getvalue()
+        files = {'sub/a.txt': b'a' * 1000, 'sub/b.txt': os.urandom(100000)}
+        tball = make_tarball(files)
+        # each entry is (content, declared content-length); truncated responses declare more
+        content = {'': (b'', 0),
+                   'data.tar.gz': (tball, len(tball)),
+                   'escape.tar.gz': (make_tarball({'ok.txt': b'ok', '../../escaped.txt': b'x'}),
+                                     None),
+                   'truncated.tar.gz': (tball[:len(tball)//2], len(tball)),
+                   'sub/a.txt': (files['sub/a.txt'], None),
+                   'sub/truncated.txt': (b'0123456789', 100000)}
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+            def do_HEAD(self):
+                requests.append(('HEAD', self.path))
+                # this server refuses HEAD requests for some paths, as some real servers do
+                if self.path.startswith('/nohead/'): self.send_response(405); self.end_headers()
+                else: self.reply(False)
+            def do_GET(self):
+                requests.append(('GET', self.path))
+                self.reply(True)
+            def reply(self, body):
+                path = self.path[1:]
+                if path.startswith('nohead/'): path = path[7:]
+                if path not in content: self.send_response(404); self.end_headers(); return
+                (dat, n) = content[path]
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(dat) if n is None else n))
+                self.end_headers()
+                if body: self.wfile.write(dat)
+        srv = HTTPServer(('127.0.0.1', 0), Handler)
+        thr = threading.Thread(target=srv.serve_forever)
+        thr.daemon = True
+        thr.start()
+        base = 'http://127.0.0.1:%d/' % srv.server_port
+        tmp = tempfile.mkdtemp(prefix='npythy_test_')
+        def cached_files(path):
+            return [fl for (_,_,fls) in os.walk(path) for fl in fls]
+        try:
+            # a tarball URL is extracted in full, and its size is known from one HEAD request
+            pd = ny.util.pseudo_dir(base + 'data.tar.gz', cache_path=os.path.join(tmp, 'c1'))
+            for (flnm, dat) in six.iteritems(files):
+                with open(pd.local_path(flnm), 'rb') as fl: self.assertEqual(fl.read(), dat)
+            if PseudoDir._pool is not None:
+                self.assertEqual(PseudoDir._cache_size_hint(base + 'data.tar.gz'), 3 * len(tball))
+                self.assertEqual(len([r for r in requests if r == ('HEAD', '/data.tar.gz')]), 1)
+            # a member that would escape the cache is refused
+            cp = os.path.join(tmp, 'a', 'b', 'c2')
+            pd = ny.util.pseudo_dir(base + 'escape.tar.gz', cache_path=cp)
+            with self.assertRaises((ValueError, tarfile.TarError)): pd.local_path('ok.txt')
+            self.assertFalse(any('escaped.txt' in fls for (_,_,fls) in os.walk(tmp)))
+            # a truncated tarball leaves nothing in the cache
+            cp = os.path.join(tmp, 'c3')
+            pd = ny.util.pseudo_dir(base + 'truncated.tar.gz', cache_path=cp)
+            with self.assertRaises(Exception): pd.local_path('sub/a.txt')
+            self.assertEqual(cached_files(cp), [])
+            # plain URLs, including those on servers that refuse HEAD requests
+            for url in (base, base + 'nohead/'):
+                cp = os.path.join(tmp, 'c4' + str(len(url)))
+                pd = ny.util.pseudo_dir(url, cache_path=cp)
+                self.assertEqual(pd.find('sub', 'a.txt'), 'sub/a.txt')
+                self.assertIsNone(pd.find('sub', 'c.txt'))
+                with open(pd.local_path('sub', 'a.txt'), 'rb') as fl:
+                    self.assertEqual(fl.read(), files['sub/a.txt'])
+                # a truncated download fails every time and leaves nothing in the cache
+                for ii in range(2):
+                    with self.assertRaises(Exception): pd.local_path('sub', 'truncated.txt')
+                self.assertEqual(cached_files(cp), ['a.txt'])
+            # existence checks are remembered (when they go through urllib3)
+            if PseudoDir._pool is not None:
+                n = len(requests)
+                self.assertTrue(PseudoDir._is_url(base + 'sub/a.txt'))
+                self.assertFalse(PseudoDir._is_url(base + 'sub/c.txt'))
+                self.assertEqual(len(requests), n)
+        finally:
+            srv.shutdown()
+            srv.server_close()
+            shutil.rmtree(tmp, True)
+
+    def test_file_map(self):
+        '''
+        test_file_map ensures that file_map objects load, filter, and handle missing files as
+          instructed, both for directories and for tarballs.
+        '''
+        import tarfile, tempfile, shutil
+        from neuropythy.util import (file_map, pseudo_dir, FileMap)
+        logging.info('neuropythy: Testing FileMap and PseudoDir')
+        tmp = tempfile.mkdtemp(prefix='npythy_test_')
+        try:
+            src = os.path.join(tmp, 'src')
+            os.makedirs(os.path.join(src, 'sub'))
+            for (flnm, x) in [('a.txt', 1), ('b.txt', 2)]:
+                with open(os.path.join(src, 'sub', flnm), 'w') as fl: fl.write(str(x))
+            # a tarball inside the directory, which should be expanded transparently
+            with tarfile.open(os.path.join(tmp, 'inner.tar.gz'), 'w:gz') as tfl:
+                tfl.add(os.path.join(src, 'sub'), arcname='sub')
+            shutil.move(os.path.join(tmp, 'inner.tar.gz'), src)
+            for (ext, mode) in [('.tar', 'w'), ('.tar.gz', 'w:gz')]:
+                with tarfile.open(os.path.join(tmp, 'src' + ext), mode) as tfl:
+                    tfl.add(os.path.join(src, 'sub'), arcname='sub')
+            tb = os.path.join(tmp, 'src.tar.gz')
+            self.assertEqual(FileMap.valid_path(tb), tb)
+            self.assertEqual(FileMap.valid_path(tb + ':sub'), tb + ':sub')
+            self.assertEqual(FileMap.valid_path(src), src)
+            self.assertIsNone(FileMap.valid_path(os.path.join(tmp, 'nonexistent')))
+            pd = pseudo_dir(src)
+            self.assertEqual(pd.find('inner.tar.gz:sub', 'a.txt'), 'inner.tar.gz:sub/a.txt')
+            self.assertIsNone(pd.find('inner.tar.gz:sub', 'c.txt'))
+            with open(pd.local_path('inner.tar.gz:sub/b.txt'), 'r') as fl:
+                self.assertEqual(fl.read(), '2')
+            # paths declared in the manifest may also be inside nested tarballs
+            pd = pseudo_dir(src)
+            pd.populate_manifest(['inner.tar.gz:sub/a.txt'])
+            self.assertEqual(pd.find('inner.tar.gz:sub/a.txt'), 'inner.tar.gz:sub/a.txt')
+            with open(pd.local_path('inner.tar.gz:sub/a.txt'), 'r') as fl:
+                self.assertEqual(fl.read(), '1')
+            instructions = ['sub', ['a.txt', {'key':'a', 'load':None},
+                                    'b.txt', {'key':'b', 'filt':lambda x,args: x * 10},
+                                    'c.txt', {'key':'c', 'miss':lambda flnm,args: flnm},
+                                    'd.txt', {'key':'d', 'miss':'error'}]]
+            def load_int(flnm, args):
+                with open(flnm, 'r') as fl: return int(fl.read())
+            for path in [src, os.path.join(tmp, 'src.tar'), tb]:
+                fm = file_map(path, instructions, load_function=load_int)
+                self.assertEqual(fm.data_tree.key['a'], 1)
+                self.assertEqual(fm.data_tree.key['b'], 20)
+                self.assertEqual(fm.data_tree.key['c'], os.path.join('sub', 'c.txt'))
+                with self.assertRaises(ValueError): fm.data_files[os.path.join('sub', 'd.txt')]
+        finally: shutil.rmtree(tmp, True)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1350,7 +1350,7 @@ def data_struct(*args, **kw):
     m = pimms.merge(*args, **kw)
     return DataStruct(**m)
 
-def tmpdir(prefix='npythy_tempdir_', delete=True):
+def tmpdir(prefix='npythy_tempdir_', delete=True, dir=None):
     '''
     tmpdir() creates a temporary directory and yields its path. At python exit, the directory and
       all of its contents are recursively deleted (so long as the the normal python exit process is
@@ -1358,8 +1358,10 @@ def tmpdir(prefix='npythy_tempdir_', delete=True):
     tmpdir(prefix) uses the given prefix in the tempfile.mkdtemp() call.
     
     The option delete may be set to False to specify that the tempdir should not be deleted on exit.
+    The option dir may specify the parent directory of the tempdir; if None (the default), then the
+    system's default temporary directory is used.
     '''
-    path = tempfile.mkdtemp(prefix=prefix)
+    path = tempfile.mkdtemp(prefix=prefix, dir=dir)
     if not os.path.isdir(path): raise ValueError('Could not find or create temp directory')
     if delete: atexit.register(shutil.rmtree, path)
     return path
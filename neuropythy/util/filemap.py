@@ -3,18 +3,39 @@
 # Utility for presenting a directory with a particular format as a data structure.
 # By Noah C. Benson
 
-import os, warnings, six, tarfile, atexit, shutil, posixpath, json, pimms
+import os, sys, re, io, gzip, string, warnings, six, tarfile, atexit, shutil, posixpath, json, pimms
+import threading
+from   collections import namedtuple
 import numpy          as np
 import pyrsistent     as pyr
 from   posixpath  import join as urljoin, split as urlsplit, normpath as urlnormpath
 from   six.moves  import urllib
 from   .core      import (library_path, curry, ObjectWithMetaData, AutoDict, data_struct, tmpdir,
                           is_tuple, is_list)
-from   .conf      import to_credentials
+from   .conf      import (config, to_credentials)
+
+if sys.version_info[0] == 3: from   collections import abc as colls
+else:                        import collections            as colls
 
 # Not required, but try to load it anyway:
 try:    import s3fs
 except: s3fs = None
+try:    import urllib3
+except: urllib3 = None
+try:    import rapidgzip
+except: rapidgzip = None
+# (Python 2 only has this via the futures backport)
+try:    from concurrent.futures import ThreadPoolExecutor
+except: ThreadPoolExecutor = None
+
+# buffer sizes used when streaming downloads and tarball contents to disk
+copy_bufsize = 2*1024*1024
+read_bufsize = 1024*1024
+
+# whether temporary cache directories should be placed on a tmpfs (/dev/shm) when one is available,
+# and how much free space the tmpfs must have for it to be used
+config.declare('cache_tmpfs', filter=bool, default_value=True)
+config.declare('cache_tmpfs_min_free', filter=int, default_value=2*1024**3)
 
 def is_url(url):
     '''
@@ -41,13 +62,13 @@ def url_download(url, topath=None, create_dirs=True):
         if topath is None: topath = response.read()
         else:
             with open(topath, 'wb') as fl:
-                shutil.copyfileobj(response, fl)
+                shutil.copyfileobj(response, fl, length=copy_bufsize)
     else:
         with urllib.request.urlopen(url) as response:
             if topath is None: topath = response.read()
             else:
                 with open(topath, 'wb') as fl:
-                    shutil.copyfileobj(response, fl)
+                    shutil.copyfileobj(response, fl, length=copy_bufsize)
     return topath
 def is_s3_path(path):
     '''
@@ -117,6 +138,11 @@ def osf_crawl(k, *pths, **kw):
     if root is None: root = _osf_tree(bpth, base=base)
     return reduce(lambda m,k: m[k], pths, root)
     
+# The internal accessors of a PseudoDir; this is read on every file lookup, so it's a namedtuple
+# rather than a pmap
+_PathData = namedtuple('_PathData', ('repr', 'exists', 'getpath', 'prefetch', 'parallel',
+                                     'sequential', 'manifest', 'cache', 'pathmod'))
+
 @pimms.immutable
 class PseudoDir(ObjectWithMetaData):
     '''
@@ -137,7 +163,8 @@ class PseudoDir(ObjectWithMetaData):
         '''
         if sp is None: return os.path.join('/')
         if not pimms.is_str(sp): raise ValueError('source_path must be a string/path')
-        if is_url(sp) or is_s3_path(sp): return sp
+        # we don't check whether URLs are reachable here (that's deferred to _path_data)
+        if '://' in sp or is_s3_path(sp): return sp
         return os.path.expanduser(os.path.expandvars(sp))
     @pimms.param
     def cache_path(cp):
@@ -165,6 +192,21 @@ class PseudoDir(ObjectWithMetaData):
         if c is None: return None
         else: return to_credentials(c)
     @staticmethod
+    def _makedirs(dnm):
+        # like os.makedirs, but doesn't fail if another thread creates the directory first
+        if os.path.isdir(dnm): return dnm
+        try: os.makedirs(os.path.abspath(dnm), 0o755)
+        except OSError:
+            if not os.path.isdir(dnm): raise
+        return dnm
+    @staticmethod
+    def _replace(src, dst):
+        # like os.replace, which Python 2 lacks; there, the target is removed then src is renamed
+        if hasattr(os, 'replace'): return os.replace(src, dst)
+        if os.path.isdir(dst) and not os.path.islink(dst): shutil.rmtree(dst)
+        elif os.path.lexists(dst): os.remove(dst)
+        os.rename(src, dst)
+    @staticmethod
     def _url_to_ospath(path):
         #if os.sep == posixpath.sep: return path
         path = urlnormpath(path)
@@ -173,21 +215,154 @@ class PseudoDir(ObjectWithMetaData):
             (path,fl) = posixpath.split(path)
             ps.append(fl)
         return os.path.join(*reversed(ps))
+    # URL existence checks (and the sizes they report) are memoized and share a single keep-alive
+    # connection pool
+    _url_cache = {}
+    _url_sizes = {}
+    _pool = None if urllib3 is None else urllib3.PoolManager(maxsize=16, block=False)
+    @staticmethod
+    def _url_head(url):
+        # a HEAD request for the url; servers that refuse HEAD requests get a GET instead (whose
+        # body is never read)
+        r = PseudoDir._pool.request('HEAD', url, retries=False)
+        if r.status in (403, 405, 501):
+            r = PseudoDir._pool.request('GET', url, retries=False, preload_content=False)
+            r.close()
+        return r
+    @staticmethod
+    def _is_url(url):
+        if url in PseudoDir._url_cache: return PseudoDir._url_cache[url]
+        if '://' not in url: return False
+        elif PseudoDir._pool is None:
+            res = is_url(url)
+            # is_url can't tell a missing url from a failed connection, so only hits are saved
+            if res: PseudoDir._url_cache[url] = res
+            return res
+        # only definite answers are remembered: errors and server failures may be transient
+        try: r = PseudoDir._url_head(url)
+        except Exception: return False
+        res = r.status < 400
+        if r.status < 500:
+            PseudoDir._url_cache[url] = res
+            n = r.headers.get('Content-Length') if res else None
+            PseudoDir._url_sizes[url] = int(n) if n is not None and n.isdigit() else None
+        return res
+    @staticmethod
+    def _url_get(url, topath):
+        # we download to a private file then move it into place so that a failed or in-progress
+        # download is never mistaken for a cached file
+        PseudoDir._makedirs(os.path.dirname(topath))
+        tmppath = '%s.part%d' % (topath, threading.current_thread().ident)
+        try:
+            if PseudoDir._pool is None:
+                r = urllib.request.urlopen(url)
+                try:
+                    n = r.info().get('Content-Length')
+                    with open(tmppath, 'wb') as fl: shutil.copyfileobj(r, fl, length=copy_bufsize)
+                finally: r.close()
+                # urllib reports a connection that closes early as the end of the file
+                if n is not None and n.isdigit() and os.path.getsize(tmppath) != int(n):
+                    raise ValueError('Incomplete download of url: %s' % url)
+            else:
+                r = PseudoDir._pool.request('GET', url, preload_content=False)
+                try:
+                    if r.status >= 400: raise ValueError('Could not download url: %s' % url)
+                    r.auto_close = False
+                    with open(tmppath, 'wb') as fl:
+                        shutil.copyfileobj(io.BufferedReader(r, buffer_size=read_bufsize), fl,
+                                           length=copy_bufsize)
+                finally: r.release_conn()
+            PseudoDir._replace(tmppath, topath)
+        finally:
+            if os.path.exists(tmppath): os.remove(tmppath)
+        return topath
     @staticmethod
     def _url_exists(urlbase, cache_path, path):
         cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
         if os.path.exists(cpath): return True
-        else: return is_url(urljoin(urlbase, path))
+        else: return PseudoDir._is_url(urljoin(urlbase, path))
     @staticmethod
     def _url_getpath(urlbase, cache_path, path):
         cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
         if os.path.exists(cpath): return cpath
         url = urljoin(urlbase, path)
-        return url_download(url, cpath)
+        return PseudoDir._url_get(url, cpath)
     @staticmethod
-    def _osf_exists(fls, osfbase, cache_path, path):
+    def _escapes(path):
+        # whether the relative path would lead outside of the directory it's relative to
+        path = posixpath.normpath(path.replace(os.sep, '/'))
+        return posixpath.isabs(path) or path == '..' or path.startswith('../')
+    @staticmethod
+    def _tar_safe_members(members):
+        # used when tarfile has no extraction filters: refuse members that would land outside of
+        # the directory into which they are extracted
+        for m in members:
+            nm = posixpath.normpath(m.name)
+            if m.issym() or m.islnk(): ln = posixpath.join(posixpath.dirname(nm), m.linkname)
+            else: ln = nm
+            if PseudoDir._escapes(nm) or PseudoDir._escapes(ln):
+                raise ValueError('Tarball member %s would be extracted outside the cache' % m.name)
+            yield m
+    @staticmethod
+    def _tar_extractall(tfl, path, members=None):
+        # tfl.extractall(path, members), but refusing members that would escape path
+        if hasattr(tarfile, 'data_filter'):
+            tfl.extractall(path, members=members, filter='data')
+        else:
+            ms = PseudoDir._tar_safe_members(tfl if members is None else members)
+            tfl.extractall(path, members=ms)
+    @staticmethod
+    def _merge_dir(src, dst):
+        # moves the contents of directory src into directory dst, replacing any existing files
+        for nm in os.listdir(src):
+            (s, d) = (os.path.join(src, nm), os.path.join(dst, nm))
+            if os.path.isdir(d) and not os.path.islink(d) and os.path.isdir(s):
+                PseudoDir._merge_dir(s, d)
+            else: PseudoDir._replace(s, d)
+    @staticmethod
+    def _url_tar_extract(url, cache_path):
+        # remote tarballs are streamed straight through tarfile, so the download and the
+        # decompression overlap and the tarball itself is never written to disk; everything is
+        # extracted into a scratch directory first so that a failed download leaves nothing behind
+        if (url, cache_path) in PseudoDir._tar_extracted: return cache_path
+        with PseudoDir._lock(url):
+            if (url, cache_path) in PseudoDir._tar_extracted: return cache_path
+            tmp = tmpdir(prefix='.partial_', delete=False, dir=cache_path)
+            try:
+                if PseudoDir._pool is None: r = urllib.request.urlopen(url)
+                else: r = PseudoDir._pool.request('GET', url, preload_content=False)
+                try:
+                    if PseudoDir._pool is not None:
+                        if r.status >= 400: raise ValueError('Could not download url: %s' % url)
+                        r.auto_close = False
+                    strm = io.BufferedReader(r, buffer_size=read_bufsize)
+                    with tarfile.open(fileobj=strm, mode='r|*') as tfl:
+                        PseudoDir._tar_extractall(tfl, tmp)
+                finally:
+                    if PseudoDir._pool is None: r.close()
+                    else: r.release_conn()
+                PseudoDir._merge_dir(tmp, cache_path)
+            finally: shutil.rmtree(tmp, True)
+            PseudoDir._tar_extracted.add((url, cache_path))
+        return cache_path
+    @staticmethod
+    def _url_tar_exists(url, cache_path, path):
+        cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
+        if os.path.exists(cpath): return True
+        PseudoDir._url_tar_extract(url, cache_path)
+        return os.path.exists(cpath)
+    @staticmethod
+    def _url_tar_getpath(url, cache_path, path):
         cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
         if os.path.exists(cpath): return cpath
+        PseudoDir._url_tar_extract(url, cache_path)
+        if not os.path.exists(cpath):
+            raise ValueError('Path %s not found in tarball %s' % (path, url))
+        return cpath
+    @staticmethod
+    def _osf_exists(fls, osfbase, cache_path, path):
+        cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
+        if os.path.exists(cpath): return True
         fl = fls
         for pp in path.split('/'):
             if   pimms.is_str(fl): return False
@@ -200,11 +375,11 @@ class PseudoDir(ObjectWithMetaData):
         if os.path.exists(cpath): return cpath
         fl = fls
         for pp in path.split('/'): fl = fl[pp]
-        return url_download(fl, cpath)
+        return PseudoDir._url_get(fl, cpath)
     @staticmethod
     def _s3_exists(fs, urlbase, cache_path, path):
         cpath = os.path.join(cache_path, PseudoDir._url_to_ospath(path))
-        if os.path.exists(cpath): return cpath
+        if os.path.exists(cpath): return True
         url = urljoin(urlbase, path)
         return fs.exists(url)
     @staticmethod
@@ -214,47 +389,259 @@ class PseudoDir(ObjectWithMetaData):
         url = urljoin(urlbase, path)
         fs.get(url, cpath)
         return cpath
+    # TarFile objects aren't thread-safe, so anything that reads through a shared handle (or
+    # extracts into a shared cache) holds the lock of its tarball (or URL)
+    _locks = {}
+    _locks_lock = threading.Lock()
+    @staticmethod
+    def _lock(key):
+        with PseudoDir._locks_lock:
+            lck = PseudoDir._locks.get(key)
+            if lck is None:
+                lck = threading.RLock()
+                PseudoDir._locks[key] = lck
+            return lck
+    # tarballs are opened once; we keep the open handle and a {name: TarInfo} dict of members
+    _tar_cache = {}
+    _tar_files = []
+    _tar_indexed = set()
+    _tar_extracted = set()
+    @staticmethod
+    def _tar_open(tarpath):
+        ltp = tarpath.lower()
+        if (ltp.endswith('.tar.gz') or ltp.endswith('.tgz')) and rapidgzip is not None:
+            # rapidgzip decompresses in parallel and supports random access; its seek index is
+            # saved next to the tarball (when possible) so that later sessions can reuse it
+            fl = rapidgzip.RapidgzipFile(tarpath, parallelization=os.cpu_count())
+            PseudoDir._tar_files.append(fl)
+            idx = tarpath + '.gzi'
+            try:
+                if os.path.isfile(idx): fl.import_index(idx)
+                else: fl.export_index(idx)
+            except Exception: pass
+            fl.seek(0)
+            tfl = tarfile.open(fileobj=fl, mode='r:')
+            PseudoDir._tar_indexed.add(tarpath)
+        elif ltp.endswith('.tar.gz') or ltp.endswith('.tgz'):
+            # gzip reads through a large buffer rather than tarfile's small default
+            fl = io.open(tarpath, 'rb', buffering=read_bufsize)
+            PseudoDir._tar_files.append(fl)
+            tfl = tarfile.open(fileobj=gzip.GzipFile(fileobj=fl, mode='rb'), mode='r:')
+        else:
+            # tarfile's bufsize only applies to stream modes, so we buffer the file ourselves
+            fl = io.open(tarpath, 'rb', buffering=read_bufsize)
+            PseudoDir._tar_files.append(fl)
+            tfl = tarfile.open(fileobj=fl, mode='r:*')
+        tfl.copybufsize = copy_bufsize
+        return tfl
+    @staticmethod
+    def _tar_sequential(tarpath):
+        # whether the tarball can only be read in a single forward pass: it's compressed and has no
+        # seek index (rapidgzip indexes .tar.gz files; see _tar_open)
+        ltp = tarpath.lower()
+        return not (ltp.endswith('.tar') or
+                    (rapidgzip is not None and ltp.endswith(('.tar.gz','.tgz'))))
+    @staticmethod
+    def _tar_data(tarpath, visit=None):
+        # if the tarball hasn't been scanned yet, visit(tfl, member) is called for each member as
+        # the scan reaches it
+        dat = PseudoDir._tar_cache.get(tarpath)
+        if dat is not None: return dat
+        with PseudoDir._lock(tarpath):
+            dat = PseudoDir._tar_cache.get(tarpath)
+            if dat is not None: return dat
+            tfl = PseudoDir._tar_open(tarpath)
+            # one sequential scan of the headers; members are also indexed under their normalized
+            # names so that, e.g., './subj/file' can be found as 'subj/file'
+            members = {}
+            for m in tfl:
+                members[m.name] = m
+                nm = posixpath.normpath(m.name)
+                if nm != m.name: members.setdefault(nm, m)
+                if visit is not None: visit(tfl, m)
+            dat = (tfl, members)
+            PseudoDir._tar_cache[tarpath] = dat
+        return dat
+    @staticmethod
+    def _tar_close_all():
+        for (tfl,_) in six.itervalues(PseudoDir._tar_cache):
+            try: tfl.close()
+            except Exception: pass
+        for fl in PseudoDir._tar_files:
+            try: fl.close()
+            except Exception: pass
+        PseudoDir._tar_cache.clear()
+        del PseudoDir._tar_files[:]
+    @staticmethod
+    def _tar_copy_range(tarpath, member, topath):
+        # members of an uncompressed tarball are contiguous byte-ranges of the tarball file, so we
+        # can let the kernel copy them without passing the data through Python
+        PseudoDir._makedirs(os.path.dirname(topath))
+        # we write to a private file then move it into place so that no one sees a partial copy
+        tmppath = '%s.part%d' % (topath, threading.current_thread().ident)
+        with open(tarpath, 'rb') as src, open(tmppath, 'wb') as dst:
+            (off, n) = (member.offset_data, member.size)
+            try:
+                while n > 0:
+                    k = os.copy_file_range(src.fileno(), dst.fileno(), n, off)
+                    if k == 0: raise ValueError('Unexpected end of tarball %s' % tarpath)
+                    (off, n) = (off + k, n - k)
+            except OSError:
+                # e.g., EXDEV when the cache is on another filesystem; finish with plain reads
+                src.seek(off)
+                dst.seek(member.size - n)
+                while n > 0:
+                    buf = src.read(min(n, copy_bufsize))
+                    if len(buf) == 0: raise ValueError('Unexpected end of tarball %s' % tarpath)
+                    dst.write(buf)
+                    n -= len(buf)
+        os.chmod(tmppath, member.mode & 0o777)
+        os.utime(tmppath, (member.mtime, member.mtime))
+        PseudoDir._replace(tmppath, topath)
+        return topath
+    @staticmethod
+    def _tar_extract(tfl, cache_path, members=None):
+        # extracts the given members (default: all) through the shared TarFile tfl; the caller
+        # must hold the tarball's lock; files only appear in the cache once fully extracted
+        tmp = tmpdir(prefix='.partial_', delete=False, dir=cache_path)
+        try:
+            PseudoDir._tar_extractall(tfl, tmp, members)
+            PseudoDir._merge_dir(tmp, cache_path)
+        finally: shutil.rmtree(tmp, True)
+        return cache_path
     @staticmethod
     def _tar_exists(tarpath, cache_path, path):
         cpath = os.path.join(cache_path, path)
         if os.path.exists(cpath): return True
-        with tarfile.open(tarpath, 'r') as tfl:
-            try: return bool(tfl.getmember(path))
-            except: return False
+        (tfl, members) = PseudoDir._tar_data(tarpath)
+        return path in members
     @staticmethod
     def _tar_getpath(tarpath, cache_path, path):
+        if PseudoDir._escapes(path):
+            raise ValueError('Path %s would be extracted outside the cache' % path)
         cpath = os.path.join(cache_path, path)
         if os.path.exists(cpath): return cpath
-        with tarfile.open(tarpath, 'r') as tfl: tfl.extract(path, cache_path)
+        (tfl, members) = PseudoDir._tar_data(tarpath)
+        if path not in members:
+            raise ValueError('Path %s not found in tarball %s' % (path, tarpath))
+        m = members[path]
+        if (tarpath.lower().endswith('.tar') and m.isreg() and not m.issparse() and
+            hasattr(os, 'copy_file_range')):
+            # this doesn't touch the shared TarFile, so it can run from any thread
+            return PseudoDir._tar_copy_range(tarpath, m, cpath)
+        with PseudoDir._lock(tarpath):
+            if os.path.exists(cpath): return cpath
+            elif tarpath.lower().endswith('.tar') or tarpath in PseudoDir._tar_indexed:
+                PseudoDir._tar_extract(tfl, cache_path, [m])
+            elif (tarpath, cache_path) not in PseudoDir._tar_extracted:
+                # compressed tarballs can't be randomly accessed, so we extract everything at once
+                PseudoDir._tar_extract(tfl, cache_path)
+                PseudoDir._tar_extracted.add((tarpath, cache_path))
         return cpath
+    @staticmethod
+    def _tar_prefetch(tarpath, cache_path, paths):
+        # yields the list of the given paths that are in the tarball
+        if tarpath not in PseudoDir._tar_cache and PseudoDir._tar_sequential(tarpath):
+            # the tarball hasn't been scanned yet, so we extract the members we need as the scan
+            # reaches them: the whole thing is decompressed only once
+            need = set(p for p in paths if not os.path.exists(os.path.join(cache_path, p)))
+            with PseudoDir._lock(tarpath):
+                tmp = tmpdir(prefix='.partial_', delete=False, dir=cache_path)
+                try:
+                    def visit(tfl, m):
+                        if m.name in need or posixpath.normpath(m.name) in need:
+                            PseudoDir._tar_extractall(tfl, tmp, [m])
+                    PseudoDir._tar_data(tarpath, visit)
+                    PseudoDir._merge_dir(tmp, cache_path)
+                finally: shutil.rmtree(tmp, True)
+        (tfl, members) = PseudoDir._tar_data(tarpath)
+        found = [p for p in paths if p in members]
+        if (tarpath, cache_path) in PseudoDir._tar_extracted: return found
+        ms = [members[p] for p in set(found) if not os.path.exists(os.path.join(cache_path, p))]
+        if len(ms) == 0: return found
+        if tarpath.lower().endswith('.tar') or tarpath in PseudoDir._tar_indexed:
+            for m in ms: PseudoDir._tar_getpath(tarpath, cache_path, m.name)
+        else:
+            # extracting in tarball order lets a compressed tarball be read in one forward pass
+            ms.sort(key=lambda m:m.offset)
+            with PseudoDir._lock(tarpath): PseudoDir._tar_extract(tfl, cache_path, ms)
+        return found
+    @staticmethod
+    def _url_size(url):
+        # the Content-Length of the given url, or None if it can't be determined; this comes from
+        # the (memoized) request made by _is_url
+        if url not in PseudoDir._url_sizes: PseudoDir._is_url(url)
+        return PseudoDir._url_sizes.get(url)
+    @staticmethod
+    def _cache_size_hint(source_path):
+        # roughly how much the cache of the given source may need to hold; None means that the
+        # cache should not be placed on tmpfs at all
+        if not pimms.is_str(source_path) or os.path.isdir(source_path): return 0
+        lsp = source_path.lower()
+        if '://' in source_path:
+            if not lsp.endswith(tarball_endings): return 0
+            # remote tarballs are extracted in full, so we need to know how large they are
+            n = PseudoDir._url_size(source_path)
+            return None if n is None else n * (1 if lsp.endswith('.tar') else 3)
+        (tb,ip) = split_tarball_path(source_path)
+        if tb is None: return 0
+        # members of a local uncompressed tarball are copied with copy_file_range; a cache on the
+        # same filesystem as the tarball lets the kernel do this without a buffered copy (which
+        # is what happens across filesystems)
+        if tb.lower().endswith('.tar'): return None
+        # the extracted contents may well be larger than the (compressed) tarball
+        return os.path.getsize(tb) * 3 if os.path.isfile(tb) else 0
+    @staticmethod
+    def _tmpfs_dir(size_hint=0):
+        if size_hint is None or not config['cache_tmpfs']: return None
+        shm = '/dev/shm'
+        if not os.path.ismount(shm): return None
+        try: free = shutil.disk_usage(shm).free
+        except Exception: return None
+        return shm if free >= max(size_hint, config['cache_tmpfs_min_free']) else None
     @pimms.value
     def _path_data(source_path, cache_path, delete, credentials):
         need_cache = True
+        prefetch_fn = None
+        # whether independent files can be downloaded/extracted from separate threads
+        parallel = True
+        # whether files can only be read in a single forward pass (i.e., a compressed tarball
+        # without a seek index), in which case fetching them together is much faster
+        sequential = False
         rpr = source_path
         # Okay, it might be a directory, an Amazon S3 URL, a different URL, or a tarball
         if os.path.isdir(source_path):
-            def exists_fn(p):  return os.path.exists(os.path.join(source_path, p))
-            def getpath_fn(p): return os.path.join(source_path, p)
+            (osjoin, osexists) = (os.path.join, os.path.exists)
+            def exists_fn(p):  return osexists(osjoin(source_path, p))
+            def getpath_fn(p): return osjoin(source_path, p)
             rpr = os.path.normpath(source_path)
-            join_fn = os.path.join
+            # local directories don't need a cache; any given cache path is ignored
             need_cache = False
+            cache_path = None
+            parallel = False
             pathmod = os.path
         elif is_tuple(source_path):
             (el0,pp) = (source_path[0], source_path[1:])
             if s3fs is not None and isinstance(el0, s3fs.S3FileSystem):
-                rpr = 'S3:/' + urljoin(*pp)
-                def ujn(p): return urljoin(*(pp + (p,)))
-                def exists_fn(p):  return PseudoDir._s3_exists(el0,  cache_path, ujn(p))
-                def getpath_fn(p): return PseudoDir._s3_getpath(el0, cache_path, ujn(p))
+                s3base = urljoin(*pp)
+                rpr = 'S3:/' + s3base
+                def exists_fn(p):  return PseudoDir._s3_exists(el0,  s3base, cache_path, p)
+                def getpath_fn(p): return PseudoDir._s3_getpath(el0, s3base, cache_path, p)
                 pathmod = posixpath
             elif isinstance(el0, PseudoDir):
                 pd = el0._path_data
                 # we can use this dir's cache directory
                 need_cache = False
-                if cache_path is None: cache_path = el0.cache_path
-                (pathmod,efn,gfn,rpr) = [pd[k] for k in ('pathmod','exists','getpath','repr')]
+                if cache_path is None: cache_path = pd.cache
+                (pathmod,efn,gfn,pfn,parallel,rpr) = (pd.pathmod, pd.exists, pd.getpath,
+                                                      pd.prefetch, pd.parallel, pd.repr)
+                sequential = pd.sequential
                 def exists_fn(p):  return efn(pathmod.join(*(pp + (p,))))
                 def getpath_fn(p): return gfn(pathmod.join(*(pp + (p,))))
+                if pfn is not None:
+                    def prefetch_fn(ps):
+                        pps = {pathmod.join(*(pp + (p,))):p for p in ps}
+                        return [pps[p] for p in pfn(list(pps))]
                 rpr = pathmod.join(*((rpr,) + pp))
         elif is_s3_path(source_path):
             if s3fs is None: raise ValueError('s3fs module is not installed')
@@ -268,59 +655,89 @@ class PseudoDir(ObjectWithMetaData):
             def exists_fn(p):  return PseudoDir._osf_exists(fs, source_path, cache_path, p)
             def getpath_fn(p): return PseudoDir._osf_getpath(fs, source_path, cache_path, p)
             pathmod = posixpath
-        elif is_url(source_path):
-            def exists_fn(pth):  return PseudoDir._url_exists(source_path,  cache_path, pth)
-            def getpath_fn(pth): return PseudoDir._url_getpath(source_path, cache_path, pth)
+        elif PseudoDir._is_url(source_path):
+            if source_path.lower().endswith(tarball_endings):
+                def exists_fn(pth):  return PseudoDir._url_tar_exists(source_path,  cache_path, pth)
+                def getpath_fn(pth): return PseudoDir._url_tar_getpath(source_path, cache_path, pth)
+                parallel = False
+            else:
+                def exists_fn(pth):  return PseudoDir._url_exists(source_path,  cache_path, pth)
+                def getpath_fn(pth): return PseudoDir._url_getpath(source_path, cache_path, pth)
             pathmod = posixpath
         # Check if it's a "<tarball>:path", like subject10.tar.gz:subject10/"
         elif is_tarball_path(source_path):
             (tb,ip) = split_tarball_path(source_path)
-            if ip is None:
+            # only uncompressed members can be copied out independently of the shared TarFile
+            parallel = tb.lower().endswith('.tar') and hasattr(os, 'copy_file_range')
+            sequential = PseudoDir._tar_sequential(tb)
+            if ip == '':
                 # tarball by itself
                 def exists_fn(p):  return PseudoDir._tar_exists(source_path,  cache_path, p)
                 def getpath_fn(p): return PseudoDir._tar_getpath(source_path, cache_path, p)
+                def prefetch_fn(ps): return PseudoDir._tar_prefetch(source_path, cache_path, ps)
             else:
                 # tarball with internal path
                 def exists_fn(p):  return PseudoDir._tar_exists(tb,  cache_path, os.path.join(ip,p))
                 def getpath_fn(p): return PseudoDir._tar_getpath(tb, cache_path, os.path.join(ip,p))
+                def prefetch_fn(ps):
+                    ips = {os.path.join(ip,p):p for p in ps}
+                    return [ips[p] for p in PseudoDir._tar_prefetch(tb, cache_path, list(ips))]
             pathmod = os.path
         # ok, don't know what it is...
         else: raise ValueError('Could not interpret source path: %s' % source_path)
-        cache_path = tmpdir(delete=(True if delete is Ellipsis else delete)) if need_cache else None
+        if not need_cache: pass
+        elif cache_path is None:
+            tmpfs = PseudoDir._tmpfs_dir(PseudoDir._cache_size_hint(source_path))
+            cache_path = tmpdir(delete=(True if delete is Ellipsis else delete), dir=tmpfs)
+        else:
+            # a cache path was given, so we use it rather than making a temporary directory; given
+            # cache paths are only deleted when explicitly requested
+            PseudoDir._makedirs(cache_path)
+            if delete is True: atexit.register(shutil.rmtree, cache_path, True)
         # one final layer on the exist and getpath functions: we want to automatically interpret
         # and expand internal tarball files as we go...
         tarballs = {}
+        tarballs_lock = threading.Lock()
+        # the manifest is the set of paths known to exist, so they needn't be checked again
+        manifest = set()
         def tar_pdir(tb, path):
-            if tb in tarballs: return tarballs[tb]
-            ostb = tb if pathmod.sep == os.sep else PseudoDir._url_to_ospath(tb)
-            pd = PseudoDir(tb, cache_path=os.path.join(cache_path, '.extracted_tarballs', tb),
-                           delete=False, meta_data={'container_path':source_path})
-            tarballs[tb] = pd
+            pd = tarballs.get(tb)
+            if pd is not None: return pd
+            with tarballs_lock:
+                if tb in tarballs: return tarballs[tb]
+                ostb = tb if pathmod.sep == os.sep else PseudoDir._url_to_ospath(tb)
+                cp = (None if cache_path is None else
+                      os.path.join(cache_path, '.extracted_tarballs', ostb))
+                pd = PseudoDir(getpath_fn(tb), cache_path=cp,
+                               delete=(Ellipsis if cp is None else False),
+                               meta_data={'container_path':source_path})
+                tarballs[tb] = pd
             return pd
         def exists_tar_fn(p):
+            if p in manifest: return True
             x = exists_fn(p)
-            if x: return True
+            if x:
+                manifest.add(p)
+                return True
             # see if x has a tarball in it
             (tb,pth) = split_tarball_path(p)
-            if tb is None or len(path) == 0: return False
+            if tb is None or len(pth) == 0 or not exists_fn(tb): return False
             if pathmod.sep != os.sep: pth = PseudoDir._url_to_ospath(pth)
             # there is a tarball: we auto-extract it into a new pseudo-dir
             tb = tar_pdir(tb, pth)
-            return tb._path_data['exists'](pth)
+            return tb._path_data.exists(pth)
         def getpath_tar_fn(p):
-            if exists_fn(p): return getpath_fn(p)
-            # see if x has a tarball in it
+            # the manifest doesn't say whether a path is a direct member of the source or is
+            # inside a nested tarball, so we don't consult it here
             (tb,pth) = split_tarball_path(p)
-            if tb is None or len(path) == 0: return getpath_fn(p)
+            if tb is None or len(pth) == 0 or exists_fn(p): return getpath_fn(p)
             if pathmod.sep != os.sep: pth = PseudoDir._url_to_ospath(pth)
             # there is a tarball: we auto-extract it into a new pseudo-dir
             tb = tar_pdir(tb, pth)
-            return tb._path_data['getpath'](pth)
-        return pyr.pmap({'repr':    rpr,
-                         'exists':  exists_tar_fn,
-                         'getpath': getpath_tar_fn,
-                         'cache':   cache_path,
-                         'pathmod': pathmod})
+            return tb._path_data.getpath(pth)
+        return _PathData(repr=rpr, exists=exists_tar_fn, getpath=getpath_tar_fn,
+                         prefetch=prefetch_fn, parallel=parallel, sequential=sequential,
+                         manifest=manifest, cache=cache_path, pathmod=pathmod)
 
     @pimms.value
     def actual_cache_path(_path_data):
@@ -329,40 +746,86 @@ class PseudoDir(ObjectWithMetaData):
           from the pdir.cache_path if the cache_path provided was None yet a temporary cache path
           was needed.
         '''
-        return _path_data['cache']
+        return _path_data.cache
     def __repr__(self):
-        p = self._path_data['repr']
+        p = self._path_data.repr
         return "pseudo_dir('%s')" % p
-    def join(self, *args):
+    # join, find, and local_path are values rather than methods: each is specialized to the
+    # pseudo-dir's path-module and accessor functions once, when first requested
+    @pimms.value
+    def join(_path_data):
         '''
         pdir.join(args...) is equivalent to os.path.join(args...) but always appropriate for the
           kind of path represented by the pseudo-dir pdir.
         '''
-        join = self._path_data['pathmod'].join
-        return join(*args)
-    def find(self, *args):
+        return _path_data.pathmod.join
+    @pimms.value
+    def find(_path_data):
         '''
         pdir.find(paths...) is similar to to os.path.join(paths...) but it only yields the joined
           relative path if it can be found inside pdir; otherwise None is yielded. Note that this
           does not extract or download the path--it merely ensures that it exists.
         '''
-        data = self._path_data
-        exfn = data['exists']
-        join = data['pathmod'].join
-        path = join(*args)
-        return path if exfn(path) else None
-    def local_path(self, *args):
+        (exfn, join) = (_path_data.exists, _path_data.pathmod.join)
+        def find(*args):
+            path = join(*args)
+            return path if exfn(path) else None
+        return find
+    @pimms.value
+    def local_path(_path_data):
         '''
         pdir.local_path(paths...) is similar to os.path.join(pdir, paths...) except that it
           additionally ensures that the path being requested is found in the pseudo-dir pdir then
           ensures that this path can be found in a local directory by downloading or extracting it
           if necessary. The local path is yielded.
         '''
+        (gtfn, join) = (_path_data.getpath, _path_data.pathmod.join)
+        def local_path(*args): return gtfn(join(*args))
+        return local_path
+    def prefetch(self, paths):
+        '''
+        pdir.prefetch(paths) ensures that all of the given relative paths that can be found in the
+          pseudo-dir pdir are extracted to its cache directory. For tarballs, this is done in a
+          single pass over the tarball, which is much faster than extracting each path on demand
+          when the tarball is compressed. For other kinds of pseudo-dirs this does nothing.
+        '''
+        pfn = self._path_data.prefetch
+        if pfn is not None: self.populate_manifest(pfn(list(paths)))
+        return self
+    def prefetch_parallel(self, paths, max_workers=8):
+        '''
+        pdir.prefetch_parallel(paths) ensures that all of the given relative paths that can be found
+          in the pseudo-dir pdir are downloaded or extracted to its cache directory, using a pool of
+          threads to fetch independent files concurrently. If the files of pdir cannot be fetched
+          independently (e.g., pdir is a compressed tarball), then this is equivalent to
+          pdir.prefetch(paths). If concurrent.futures is not available, the files are fetched one at
+          a time.
+
+        The optional argument max_workers (default: 8) specifies the number of threads to use.
+        '''
         data = self._path_data
-        gtfn = data['getpath']
-        join = data['pathmod'].join
-        path = join(*args)
-        return gtfn(path)
+        if not data.parallel: return self.prefetch(paths)
+        (exfn, gtfn) = (data.exists, data.getpath)
+        paths = list(set(paths))
+        if len(paths) == 0: return self
+        def fetch(p):
+            if exfn(p): gtfn(p)
+        # the first fetch sets up any shared state (e.g., a tarball's member index)
+        fetch(paths[0])
+        if ThreadPoolExecutor is None:
+            for p in paths[1:]: fetch(p)
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as ex: list(ex.map(fetch, paths[1:]))
+        return self
+    def populate_manifest(self, paths):
+        '''
+        pdir.populate_manifest(paths) declares that each of the given relative paths exists in the
+          pseudo-dir pdir; subsequent calls to pdir.find() for these paths need not check the source
+          (e.g., via an HTTP request). Note that paths found by pdir.find() or pdir.prefetch() are
+          automatically added to the manifest.
+        '''
+        self._path_data.manifest.update(paths)
+        return self
     def local_cache_path(self, *args):
         '''
         pdir.local_cache_path(paths...) is similar to os.path.join(pdir, paths...) except that it
@@ -372,9 +835,10 @@ class PseudoDir(ObjectWithMetaData):
         '''
         # if the file exists in the pseudo-dir, just return the local path
         if self.find(*args) is not None: return self.local_path(*args)
-        cp = self._path_data['cache']
+        cp = self._path_data.cache
         if cp is None: cp = self.source_path
         return os.path.join(cp, *args)
+atexit.register(PseudoDir._tar_close_all)
 def pseudo_dir(source_path, cache_path=None, delete=Ellipsis, credentials=None, meta_data=None):
     '''
     pseudo_dir(source_path) yields a pseudo-directory object that represents files in the given
@@ -407,6 +871,59 @@ def pseudo_dir(source_path, cache_path=None, delete=Ellipsis, credentials=None,
     return PseudoDir(source_path, cache_path=cache_path, delete=delete, credentials=credentials,
                      meta_data=meta_data)
     
+# Filename templates are parsed once and then filled in directly; only templates whose fields are
+# plain names are handled this way--anything else (e.g., '{0[id]}') goes through str.format
+_format_cache = {}
+_plain_field = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+def _parse_format(fmt):
+    if fmt in _format_cache: return _format_cache[fmt]
+    parsed = tuple(string.Formatter().parse(fmt))
+    for (_, fld, spec, conv) in parsed:
+        if fld is None: continue
+        if not _plain_field.match(fld) or '{' in spec or conv not in (None, 'r', 's'):
+            parsed = None
+            break
+    _format_cache[fmt] = parsed
+    return parsed
+def _apply_format(parsed, inst, params):
+    parts = []
+    for (lit, fld, spec, conv) in parsed:
+        parts.append(lit)
+        if fld is None: continue
+        v = inst[fld] if fld in inst else params[fld]
+        if   conv == 'r': v = repr(v)
+        elif conv == 's': v = str(v)
+        parts.append(format(v, spec))
+    return ''.join(parts)
+
+class _FileLoadMap(colls.Mapping):
+    '''
+    _FileLoadMap is a read-only lazy map of filenames to loaded file data used by the FileMap class.
+    Unlike a pimms lazy map, it stores only a tuple of loader arguments for each file and calls the
+    load function on those arguments the first time the file is requested.
+    '''
+    def __init__(self, entries, loadfn):
+        self._entries = entries
+        self._loadfn = loadfn
+        self._memo = {}
+    def __getitem__(self, k):
+        if k in self._memo: return self._memo[k]
+        v = self._loadfn(*self._entries[k])
+        self._memo[k] = v
+        return v
+    def __iter__(self): return iter(self._entries)
+    def __len__(self): return len(self._entries)
+    def __contains__(self, k): return k in self._entries
+    def is_lazy(self, k):
+        '''
+        lmap.is_lazy(k) yields True if the file k has not yet been loaded and False otherwise.
+        '''
+        return k in self._entries and k not in self._memo
+    def __repr__(self):
+        s = ', '.join(['%s: %s' % (repr(k), '<lazy>' if self.is_lazy(k) else self[k])
+                       for k in self._entries])
+        return 'lmap({' + s + '})'
+
 @pimms.immutable
 class FileMap(ObjectWithMetaData):
     '''
@@ -414,7 +931,8 @@ class FileMap(ObjectWithMetaData):
     with a valid path containing data of that format.
     '''
     def __init__(self, path, instructions, path_parameters=None, data_hierarchy=None,
-                 cache_path=None, cache_delete=Ellipsis, load_function=None, meta_data=None, **kw):
+                 cache_path=None, cache_delete=Ellipsis, load_function=None, eager=False,
+                 meta_data=None, **kw):
         ObjectWithMetaData.__init__(self, meta_data=meta_data)
         self.path = path
         self.instructions = instructions
@@ -424,6 +942,7 @@ class FileMap(ObjectWithMetaData):
         self.load_function = load_function
         self.cache_path = cache_path
         self.cache_delete = cache_delete
+        self.eager = eager
     _tarball_endings = tuple([('.tar' + s) for s in ('','.gz','.bz2','.lzma')])
     @staticmethod
     def valid_path(p):
@@ -435,9 +954,9 @@ class FileMap(ObjectWithMetaData):
         '''
         if   os.path.isdir(p):   return os.path.abspath(p)
         elif is_s3_path(p):      return p
-        elif is_url(p):          return p
+        elif '://' in p:         return p
         # could still be a tarball path
-        (tb,p) = split_tarball_path(path)
+        (tb,p) = split_tarball_path(p)
         if   tb is None: return None
         elif p  == '':   return os.path.abspath(tb)
         else:            return os.path.abspath(tb) + ':' + p
@@ -473,6 +992,13 @@ class FileMap(ObjectWithMetaData):
         if d in [True,False,Ellipsis]: return d
         raise ValueError('cache_delete must be True, False, or Ellipsis')
     @pimms.param
+    def eager(e):
+        '''
+        filemap.eager is True if the filemap downloads/extracts all of its files (using a pool of
+        threads where possible) when its data_files are first requested and False otherwise.
+        '''
+        return bool(e)
+    @pimms.param
     def path(p):
         '''
         filemap.path is the root path of the filemap object. 
@@ -536,42 +1062,34 @@ class FileMap(ObjectWithMetaData):
         hierarchies = hierarchy if hierarchy else []
         if len(hierarchies) > 0 and pimms.is_str(hierarchies[0]): hierarchies = [hierarchies]
         known_filekeys = ('load','filt','when','then','miss')
-        hierarchies = list(hierarchies)
+        hierarchies = [(frozenset(hrow), hrow) for hrow in hierarchies]
+        # the matching hierarchy depends only on an instruction's keys, so we remember it
+        hmatches = {}
+        bases = {}
         def handle_file(inst):
             # If it's a tuple, we just do each of them
             if isinstance(inst, tuple):
                 for ii in inst: handle_file(ii)
                 return None
-            # first, walk the hierarchies; if we find one that matches, we use it; otherwise we make
-            # one up
-            dat = None
-            for hrow in hierarchies:
-                if not all(h in inst for h in hrow): continue
-                dat = data_tree
-                for h in hrow:
-                    v = inst[h]
-                    if h not in dat: dat[h] = {}
-                    dat = dat[h]
-                    if v not in dat: dat[v] = {}
-                    dat = dat[v]
-                break
-            if dat is None:
-                # we're gonna make up a hierarchy
-                hh = []
-                dat = data_tree
-                for (k,v) in six.iteritems(inst):
-                    if k in known_filekeys: continue
-                    hh.append(k)
-                    if k not in dat: dat[k] = {}
-                    dat = dat[k]
-                    if v not in dat: dat[v] = {}
-                    dat = dat[v]
-                # append this new hierarchy to the hierarchies
-                hierarchies.append(hh)
+            # first, find the first hierarchy that matches, if any; otherwise we make one up
+            ikeys = frozenset(inst)
+            if ikeys in hmatches: hrow = hmatches[ikeys]
+            else:
+                hrow = next((hrow for (hks,hrow) in hierarchies if hks <= ikeys), None)
+                if hrow is None:
+                    hrow = [k for k in six.iterkeys(inst) if k not in known_filekeys]
+                    hierarchies.append((frozenset(hrow), hrow))
+                hmatches[ikeys] = hrow
+            dat = data_tree
+            for h in hrow: dat = dat.setdefault(h, {}).setdefault(inst[h], {})
             # Okay, we have the data, get the filename
             flnm = os.path.join(*dirstack)
-            # add this data ot the data tree
-            dat[flnm] = pyr.pmap(inst).set('_relpath', flnm)
+            # add this data ot the data tree; instructions are usually already pmaps (and repeated
+            # instruction dicts are only converted once), so this is just a single-key update
+            if isinstance(inst, pyr.PMap): base = inst
+            elif id(inst) in bases: base = bases[id(inst)]
+            else: base = bases.setdefault(id(inst), pyr.pmap(inst))
+            dat[flnm] = base.set('_relpath', flnm)
             data_files[flnm] = inst
             return None
         def handle_dir(inst):
@@ -603,11 +1121,16 @@ class FileMap(ObjectWithMetaData):
         filemap.actual_cache_path is the cache path used by the filemap, if needed.
         '''
         if cache_path is not None: return cache_path
-        if (is_url(path) or is_s3_path(path) or is_tarball_path(path) or
-            any(is_url(s) or is_s3_path(s) or is_tarball_path(s)
-                for s in six.itervalues(supplemental_paths))):
-            # we need a cache path...
-            return tmpdir(delete=(True if cache_delete is Ellipsis else cache_delete))
+        # URLs are recognized by their scheme alone; only remote tarballs need a (memoized) HEAD
+        # request, to decide whether they fit on tmpfs, and it is shared with their pseudo-dirs
+        def _remote(s): return '://' in s or is_s3_path(s) or is_tarball_path(s)
+        paths = [path] + list(six.itervalues(supplemental_paths))
+        if any(_remote(s) for s in paths):
+            # we need a cache path; it goes on tmpfs only if every source can share it there
+            hints = [PseudoDir._cache_size_hint(s) for s in paths]
+            size = None if None in hints else sum(hints)
+            return tmpdir(delete=(True if cache_delete is Ellipsis else cache_delete),
+                          dir=PseudoDir._tmpfs_dir(size))
         else: return None
     @pimms.require
     def setup_cache_deletion(cache_path, actual_cache_path, cache_delete):
@@ -619,34 +1142,35 @@ class FileMap(ObjectWithMetaData):
             atexit.register(shutil.rmtree, cache_path)
         return True
     @staticmethod
-    def _load(pdir, flnm, loadfn, *argmaps, **kwargs):
+    def _load(pdir, flnm, loadfn, filtfn, miss, args):
         try:
             lpth = pdir.local_path(flnm)
-            args = pimms.merge(*argmaps, **kwargs)
-            loadfn = inst['load'] if 'load' in args else loadfn
-            filtfn = inst['filt'] if 'filt' in args else lambda x,y:x
             dat = loadfn(lpth, args)
-            dat = filtfn(dat, args)
-        except: dat = None
+            if filtfn is not None: dat = filtfn(dat, args)
+        except Exception: dat = None
         # check for miss instructions if needed
-        if dat is None and 'miss' in args:
-            miss = args['miss']
-        elif pimms.is_str(miss) and miss.lower() in ('error','raise','exception'):
-            raise ValueError('File %s failed to load' % flnm)
-        elif miss is not None:
-            dat = miss(flnm, args)
-        return dat
+        if dat is not None or miss is None: return dat
+        elif pimms.is_str(miss):
+            if miss.lower() in ('error','raise','exception'):
+                raise ValueError('File %s failed to load' % flnm)
+            else: raise ValueError('Unrecognized miss instruction for file %s: %s' % (flnm, miss))
+        else: return miss(flnm, args)
+    @staticmethod
+    def _spath_regex(spaths):
+        # matches the 'supplemental_path_name:' prefix of a filename
+        ks = [k for k in six.iterkeys(spaths) if k is not None]
+        if len(ks) == 0: return None
+        return re.compile('^(' + '|'.join(re.escape(k) for k in ks) + '):')
     @staticmethod
-    def _parse_path(flnm, path, spaths, path_parameters, inst):
-        flnm = flnm.format(**pimms.merge(path_parameters, inst))
-        p0 = None
-        for k in six.iterkeys(spaths):
-            if flnm.startswith(k + ':'):
-                (flnm, p0) = (flnm[(len(k)+1):], k)
-                break
-        return (p0, flnm)
+    def _parse_path(flnm, spath_re, path_parameters, inst):
+        parsed = _parse_format(flnm)
+        if parsed is None: flnm = flnm.format(**pimms.merge(path_parameters, inst))
+        else:              flnm = _apply_format(parsed, inst, path_parameters)
+        m = None if spath_re is None else spath_re.match(flnm)
+        if m is None: return (None, flnm)
+        else:         return (m.group(1), flnm[m.end():])
     @pimms.value
-    def psuedo_dirs(path, supplemental_paths, actual_cache_path):
+    def pseudo_dirs(path, supplemental_paths, actual_cache_path):
         '''
         fmap.pseudo_dirs is a mapping of pseduo-dirs in the file-map fmap. The primary path's
         pseudo-dir is mapped to the key None.
@@ -668,43 +1192,75 @@ class FileMap(ObjectWithMetaData):
         spaths[None] = pseudo_dir(path, delete=False, cache_path=cp)
         return pyr.pmap(spaths)
     @pimms.value
-    def data_files(pseudo_dirs, path_parameters, load_function, meta_data, _parsed_instructions):
+    def data_files(pseudo_dirs, path_parameters, load_function, eager, meta_data,
+                   _parsed_instructions):
         '''
         filemap.data_files is a lazy map whose keys are filenames and whose values are the loaded
         files.
         '''
         (data_files, data_tree) = _parsed_instructions
+        spath_re = FileMap._spath_regex(pseudo_dirs)
+        args0 = pimms.merge(path_parameters, meta_data)
+        load = FileMap._load
+        def _loader(pathnm, fn, inst, loadfn, filtfn, miss):
+            return load(pseudo_dirs[pathnm], fn, loadfn, filtfn, miss, pimms.merge(args0, inst))
         res = {}
+        fetch = {}
         for (flnm, inst) in six.iteritems(data_files):
-            (pathnm, fn) = FileMap._parse_path(flnm, path, pseudo_dirs, path_parameters, inst)
-            res[fn] = curry(FileMap._load,
-                            pseudo_dirs[pathnm], flnm, load_function,
-                            path_parameters, meta_data, inst)
-        return pimms.lazy_map(res)
+            (pathnm, fn) = FileMap._parse_path(flnm, spath_re, path_parameters, inst)
+            # the load/filt/miss instructions are resolved here rather than at each load
+            res[fn] = (pathnm, fn, inst,
+                       inst.get('load') or load_function, inst.get('filt'), inst.get('miss'))
+            fetch.setdefault(pathnm, []).append(fn)
+        # for tarballs that can only be read sequentially, extract everything we reference in one
+        # pass rather than file-by-file; other files are fetched when loaded unless we're eager
+        for (pathnm, fns) in six.iteritems(fetch):
+            pdir = pseudo_dirs[pathnm]
+            if eager: pdir.prefetch_parallel(fns)
+            elif pdir._path_data.sequential: pdir.prefetch(fns)
+        return _FileLoadMap(res, _loader)
     @pimms.value
-    def data_tree(_parsed_instructions, path, supplemental_paths, path_parameters, data_files):
+    def data_tree(_parsed_instructions, supplemental_paths, path_parameters, data_files):
         '''
         filemap.data_tree is a lazy data-structure of the data loaded by the filemap's instructions.
         '''
         data_tree = _parsed_instructions[1]
-        def visit_data(d):
-            d = {k:visit_maps(v) for (k,v) in six.iteritems(d)}
-            return data_struct(d)
-        def visit_maps(m):
-            r = {}
-            anylazy = False
+        spath_re = FileMap._spath_regex(supplemental_paths)
+        def _leaf(fn): return lambda:data_files[fn]
+        def _is_leaf(v): return len(v) > 0 and '_relpath' in next(six.itervalues(v))
+        # The tree alternates between data levels (hierarchy keys such as 'hemi', which become
+        # data-structs) and map levels (values such as 'lh', which become (lazy) maps). We first
+        # list the nodes in pre-order, noting each one's parent and the keys it's stored under;
+        # leaves are filled in as we go.
+        nodes = [(data_tree, True, None, ())]
+        parts = [{}]
+        anylazy = [False]
+        ii = 0
+        while ii < len(nodes):
+            (m, isdata, _, _) = nodes[ii]
+            r = parts[ii]
             for (k,v) in six.iteritems(m):
-                kk = k if isinstance(k, tuple) else [k]
-                for k in kk:
-                    if len(v) > 0 and '_relpath' in next(six.itervalues(v)):
-                        (flnm,inst) = next(six.iteritems(v))
-                        flnm = FileMap._deduce_filename(flnm, path, supplemental_paths,
-                                                        path_parameters, inst)
-                        r[k] = curry(lambda flnm:data_files[flnm], flnm)
-                        anylazy = True
-                    else: r[k] = visit_data(v)
-            return pimms.lazy_map(r) if anylazy else pyr.pmap(r)
-        return visit_data(data_tree)
+                ks = (k,) if isdata or not isinstance(k, tuple) else k
+                if not isdata and _is_leaf(v):
+                    (flnm,inst) = next(six.iteritems(v))
+                    fn = FileMap._parse_path(flnm, spath_re, path_parameters, inst)[1]
+                    for k in ks: r[k] = _leaf(fn)
+                    anylazy[ii] = True
+                else:
+                    for k in ks: r[k] = None
+                    nodes.append((v, not isdata, ii, ks))
+                    parts.append({})
+                    anylazy.append(False)
+            ii += 1
+        # Then we build them in reverse order, so that each node's children are already built.
+        for ii in reversed(range(len(nodes))):
+            (_, isdata, pi, ks) = nodes[ii]
+            r = parts[ii]
+            if isdata:          val = data_struct(r)
+            elif anylazy[ii]:   val = pimms.lazy_map(r)
+            else:               val = pyr.pmap(r)
+            if pi is None: return val
+            for k in ks: parts[pi][k] = val
 def file_map(path, instructions, **kw):
     '''
     file_map(path, instructions) yields a file-map object for the given path and instruction-set.
@@ -723,6 +1279,8 @@ def file_map(path, instructions, **kw):
        neuropythy.hcp.files.hcp_filemap_data_hierarchy.
      * load_function (default: None) may specify the function that is used to load filenames; if
        None then neuropythy.io.load is used.
+     * eager (default: False) may be set to True to download/extract all of the files in the
+       file-map up front, using a pool of threads where possible, rather than as they are needed.
      * meta_data (default: None) may be passed on to the FileMap object.
 
     Any additional keyword arguments given to the file_map function will be used as supplemental